@@ -13,166 +13,339 @@
 # distribution.
 
 from enum import Enum
-from utils import dotdict
-
-Flag = dotdict({
-    'none' : 0,
-    'requireMinimalEncoding' : 1 << 0
-})    
-
-
-Tag = dotdict({
-    'Major': dotdict(
-        {
-            'unsignedInteger': 0,
-            'negativeInteger' : 1 << 5,
-            'byteString' : 2 << 5,
-            'textString' : 3 << 5,
-            'array' : 4 << 5,
-            'map' : 5 << 5,
-            'semantic' : 6 << 5,
-            'floatingPoint' : 7 << 5,
-            'simple' : 7 << 5,
-            'mask' : 0xe0,
-        }
-    ),
-    'Minor': dotdict(
-        {
-            'length1' : 24,
-            'length2' : 25,
-            'length4' : 26,
-            'length8' : 27,
-
-            'false' : 20,
-            'true' : 21,
-            'null' : 22,
-            'undefined' : 23,
-            'halfFloat' : 25, # not implemented
-            'singleFloat' : 26,
-            'doubleFloat' : 27,
-
-            'dataTime' : 0,
-            'epochDataTime' : 1,
-            'positiveBignum' : 2,
-            'negativeBignum' : 3,
-            'decimalFraction' : 4,
-            'bigfloat' : 5,
-            'convertBase64Url' : 21,
-            'convertBase64' : 22,
-            'convertBase16' : 23,
-            'cborEncodedData' : 24,
-            'uri' : 32,
-            'base64Url' : 33,
-            'base64' : 34,
-            'regex' : 35,
-            'mimeMessage' : 36,
-            'selfDescribeCbor' : 55799,
-            'mask' : 0x1f
-        }
-    ),
-    'undefined': (6 << 5) + 23
-})
+import struct
+from struct import pack_into, unpack_from
+from constants import MAX_UINT8, MAX_UINT16, MAX_UINT32, MAX_UINT64
+
+class Flag:
+    none = 0
+    requireMinimalEncoding = 1 << 0
+
+
+class Tag:
+    class Major:
+        unsignedInteger = 0
+        negativeInteger = 1 << 5
+        byteString = 2 << 5
+        textString = 3 << 5
+        array = 4 << 5
+        map = 5 << 5
+        semantic = 6 << 5
+        floatingPoint = 7 << 5
+        simple = 7 << 5
+        mask = 0xe0
+
+    class Minor:
+        length1 = 24
+        length2 = 25
+        length4 = 26
+        length8 = 27
+
+        false = 20
+        true = 21
+        null = 22
+        undefined = 23
+        halfFloat = 25 # not implemented
+        singleFloat = 26
+        doubleFloat = 27
+
+        dataTime = 0
+        epochDataTime = 1
+        positiveBignum = 2
+        negativeBignum = 3
+        decimalFraction = 4
+        bigfloat = 5
+        convertBase64Url = 21
+        convertBase64 = 22
+        convertBase16 = 23
+        cborEncodedData = 24
+        uri = 32
+        base64Url = 33
+        base64 = 34
+        regex = 35
+        mimeMessage = 36
+        selfDescribeCbor = 55799
+        mask = 0x1f
+
+    undefined = (6 << 5) + 23
+
+# Module-level aliases of the constants used on the encode/decode paths, so
+# each use is a single global lookup instead of two attribute lookups.
+_MAJ_UINT = Tag.Major.unsignedInteger
+_MAJ_NEG = Tag.Major.negativeInteger
+_MAJ_BSTR = Tag.Major.byteString
+_MAJ_TSTR = Tag.Major.textString
+_MAJ_ARR = Tag.Major.array
+_MAJ_MAP = Tag.Major.map
+_MAJ_SEM = Tag.Major.semantic
+_MAJ_SIMP = Tag.Major.simple
+_MAJ_MASK = Tag.Major.mask
+_MIN_MASK = Tag.Minor.mask
+_MIN_L1 = Tag.Minor.length1
+_MIN_L2 = Tag.Minor.length2
+_MIN_L4 = Tag.Minor.length4
+_MIN_L8 = Tag.Minor.length8
+_MIN_FALSE = Tag.Minor.false
+_MIN_TRUE = Tag.Minor.true
+_MIN_CBOR_DATA = Tag.Minor.cborEncodedData
+_FLAG_MINIMAL = Flag.requireMinimalEncoding
+
+# Fixed encodings: the two simple boolean bytes and the tag 24 (encoded CBOR
+# data) prefix, which always takes the one byte length form
+_TRUE = _MAJ_SIMP | _MIN_TRUE
+_FALSE = _MAJ_SIMP | _MIN_FALSE
+_CBOR_DATA_PREFIX = bytes([_MAJ_SEM | _MIN_L1, _MIN_CBOR_DATA])
 
 class TagMisc(Enum):
     undefined = Tag.Major.semantic + Tag.Minor.undefined
 
+# Largest header encodeTagAndValue() can write: the tag byte plus 8 bytes
+_MAX_HEADER_SIZE = 9
+
+# Errors raised when a read runs past the end of the input. CPython's
+# unpack_from raises struct.error; MicroPython has no struct.error and raises
+# ValueError instead.
+_SHORT_INPUT_ERRORS = (IndexError, ValueError, getattr(struct, 'error', ValueError))
+
+# Minimal number of bytes needed to hold value, or 0 if it fits in the tag
+# byte. This is not the CBOR header width (3 bytes are written as 4). The
+# encoder doesn't call this (see _encode_tv and _header_size); it's kept for
+# external callers.
 def get_byte_length(value):
     if value < 24:
         return 0
     
     return (value.bit_length() + 7) // 8
 
+# Write the header for tag and value into buf at pos and return the position
+# just past it: the tag byte followed by a big-endian 1/2/4/8 byte value. The
+# caller must make sure buf has room for _MAX_HEADER_SIZE bytes.
+# Ordered so the most common case, a value that fits in the tag byte, costs a
+# single comparison.
+def _encode_tv(buf, pos, tag, value):
+    if value < 24:
+        buf[pos] = tag | value
+        return pos + 1
+    if value <= MAX_UINT8:
+        pack_into('>BB', buf, pos, tag | _MIN_L1, value)
+        return pos + 2
+    if value <= MAX_UINT16:
+        pack_into('>BH', buf, pos, tag | _MIN_L2, value)
+        return pos + 3
+    if value <= MAX_UINT32:
+        pack_into('>BI', buf, pos, tag | _MIN_L4, value)
+        return pos + 5
+    if value <= MAX_UINT64:
+        pack_into('>BQ', buf, pos, tag | _MIN_L8, value)
+        return pos + 9
+
+    raise Exception("Unsupported byte length of {} for value in encodeTagAndValue()".format((value.bit_length() + 7) // 8))
+
+# Number of bytes _encode_tv() writes for value, including the tag byte
+def _header_size(value):
+    if value < 24:
+        return 1
+    if value <= MAX_UINT8:
+        return 2
+    if value <= MAX_UINT16:
+        return 3
+    if value <= MAX_UINT32:
+        return 5
+    return 9
+
+def _decode_tv(buf, pos, flags):
+    # Reads past the end of buf raise one of _SHORT_INPUT_ERRORS; they are
+    # reported as "Not enough input" rather than checking the remaining
+    # length before every read.
+    try:
+        octet = buf[pos]
+        pos += 1
+        tag = octet & _MAJ_MASK
+        additional = octet & _MIN_MASK
+        if additional < _MIN_L1:
+            return (tag, additional, pos)
+
+        if additional == _MIN_L8:
+            value = unpack_from('>Q', buf, pos)[0]
+            pos += 8
+        elif additional == _MIN_L4:
+            value = unpack_from('>I', buf, pos)[0]
+            pos += 4
+        elif additional == _MIN_L2:
+            value = unpack_from('>H', buf, pos)[0]
+            pos += 2
+        elif additional == _MIN_L1:
+            value = buf[pos]
+            pos += 1
+        else:
+            raise Exception("Bad additional value")
+    except _SHORT_INPUT_ERRORS:
+        raise Exception("Not enough input") from None
+
+    if ((flags & _FLAG_MINIMAL) and value == 0):
+        raise Exception("Encoding not minimal")
+    return (tag, value, pos)
+
+# Free list of encoder buffers, so that encoding many small messages (e.g.
+# fountain parts) doesn't allocate a new buffer for each one.
+class _BufPool:
+    _pool = []
+    _MAX_COUNT = 4
+    _MAX_SIZE = 4096
+
+    @classmethod
+    def acquire(cls, capacity):
+        # pop() and catch rather than test-then-pop, so that encoders on other
+        # threads emptying the pool in between can't make this fail
+        try:
+            buf = cls._pool.pop()
+        except IndexError:
+            return bytearray(capacity)
+        if len(buf) < capacity:
+            buf.extend(bytes(capacity - len(buf)))
+        return buf
+
+    @classmethod
+    def release(cls, buf):
+        if len(cls._pool) < cls._MAX_COUNT and len(buf) <= cls._MAX_SIZE:
+            cls._pool.append(buf)
+
 class CBOREncoder:
-    def __init__(self):
-        self.buf = bytearray()
+    def __init__(self, initial_capacity=256):
+        # The buffer is allocated up front and filled in place; self._pos
+        # marks the end of the encoded data.
+        self.buf = _BufPool.acquire(initial_capacity)
+        self._pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
     def get_bytes(self):
-        return self.buf
+        return self.buf[:self._pos]
+
+    # Returns the buffer to the pool; the encoder can't be used afterwards.
+    # The whole buffer is zeroed first, including any bytes past self._pos
+    # left by a failed encode, so encoded data (which may be key material)
+    # doesn't linger in pooled buffers.
+    def close(self):
+        if self.buf is not None:
+            self.buf[:] = bytes(len(self.buf))
+            _BufPool.release(self.buf)
+            self.buf = None
+            self._pos = 0
+
+    def _reserve(self, count):
+        # Grow the buffer (at least doubling it) when count more bytes won't fit
+        buf = self.buf
+        if self._pos + count > len(buf):
+            buf.extend(bytes(max(count, len(buf))))
+
+    # The write paths below work on local copies of self.buf and self._pos,
+    # write self._pos back once, and only call _reserve() when out of room.
+
+    def _write(self, data):
+        buf = self.buf
+        pos = self._pos
+        end = pos + len(data)
+        if end > len(buf):
+            self._reserve(len(data))
+        buf[pos : end] = data
+        self._pos = end
+
+    def _write_byte(self, octet):
+        buf = self.buf
+        pos = self._pos
+        if pos >= len(buf):
+            self._reserve(1)
+        buf[pos] = octet
+        self._pos = pos + 1
 
     def encodeTagAndAdditional(self, tag, additional):
-        self.buf.append(tag + additional)
+        self._write_byte(tag + additional)
         return 1
 
     def encodeTagAndValue(self, tag, value):
-        length = get_byte_length(value)
-
-        # 5-8 bytes required, use 8 bytes
-        if length >= 5 and length <= 8:
-            self.encodeTagAndAdditional(tag, Tag.Minor.length8)
-            self.buf.append((value >> 56) & 0xff)
-            self.buf.append((value >> 48) & 0xff)
-            self.buf.append((value >> 40) & 0xff)
-            self.buf.append((value >> 32) & 0xff)
-            self.buf.append((value >> 24) & 0xff)
-            self.buf.append((value >> 16) & 0xff)
-            self.buf.append((value >> 8) & 0xff)
-            self.buf.append(value & 0xff)
-
-        # 3-4 bytes required, use 4 bytes
-        elif length == 3 or length == 4:
-            self.encodeTagAndAdditional(tag, Tag.Minor.length4)
-            self.buf.append((value >> 24) & 0xff)
-            self.buf.append((value >> 16) & 0xff)
-            self.buf.append((value >> 8) & 0xff)
-            self.buf.append(value & 0xff)
-
-        elif length == 2:
-            self.encodeTagAndAdditional(tag, Tag.Minor.length2)
-            self.buf.append((value >> 8) & 0xff)
-            self.buf.append(value & 0xff)
-
-        elif length == 1:
-            self.encodeTagAndAdditional(tag, Tag.Minor.length1)
-            self.buf.append(value & 0xff)
-
-        elif length == 0:
-            self.encodeTagAndAdditional(tag, value)
-
-        else:
-            raise Exception("Unsupported byte length of {} for value in encodeTagAndValue()".format(length))
-
-        encoded_size = 1 + length
-        return encoded_size
+        buf = self.buf
+        start = self._pos
+        if start + _MAX_HEADER_SIZE > len(buf):
+            self._reserve(_MAX_HEADER_SIZE)
+        pos = _encode_tv(buf, start, tag, value)
+        self._pos = pos
+        return pos - start
 
     def encodeUnsigned(self, value):
-        return self.encodeTagAndValue(Tag.Major.unsignedInteger, value)
+        return self.encodeTagAndValue(_MAJ_UINT, value)
 
     def encodeNegative(self, value):
-        return self.encodeTagAndValue(Tag.Major.negativeInteger, value)
+        return self.encodeTagAndValue(_MAJ_NEG, value)
 
     def encodeInteger(self, value):
         if value >= 0:
-            return self.encodeUnsigned(value)
-        else:
-            return self.encodeNegative(value)
+            return self.encodeTagAndValue(_MAJ_UINT, value)
+        return self.encodeTagAndValue(_MAJ_NEG, -1 - value)
 
     def encodeBool(self, value):
-        return self.encodeTagAndValue(Tag.Major.simple, Tag.Minor.true if value else Tag.Minor.false)
+        self._write_byte(_TRUE if value else _FALSE)
+        return 1
 
     def encodeBytes(self, value):
-        length = self.encodeTagAndValue(Tag.Major.byteString, len(value))
-        self.buf += value
+        length = self.encodeTagAndValue(_MAJ_BSTR, len(value))
+        self._write(value)
         return length + len(value)
 
+    # Writes the tag and byteString header for value bytes of encoded data;
+    # the caller appends the data itself.
     def encodeEncodedBytesPrefix(self, value):
-        length = self.encodeTagAndValue(Tag.Major.semantic, Tag.Minor.cborEncodedData)
-        return length + self.encodeTagAndAdditional
+        self._write(_CBOR_DATA_PREFIX)
+        return 2 + self.encodeTagAndValue(_MAJ_BSTR, value)
 
     def encodeEncodedBytes(self, value):
-        length = self.encodeTagAndValue(Tag.Major.semantic, Tag.Minor.cborEncodedData)
-        return length + self.encodeBytes(value)
+        self._write(_CBOR_DATA_PREFIX)
+        return 2 + self.encodeBytes(value)
 
     def encodeText(self, value):
-        str_len = len(value)
-        length = self.encodeTagAndValue(Tag.Major.textString, str_len)
-        self.buf.append(bytes(value, 'utf8'))
-        return length + str_len
+        encoded = value.encode('utf-8')
+        byte_len = len(encoded)
+        length = self.encodeTagAndValue(_MAJ_TSTR, byte_len)
+        self._write(encoded)
+        return length + byte_len
 
     def encodeArraySize(self, value):
-        return self.encodeTagAndValue(Tag.Major.array, value)
+        if value < 24:
+            self._write_byte(_MAJ_ARR | value)
+            return 1
+        return self.encodeTagAndValue(_MAJ_ARR, value)
+
+    # Writes an array of unsigned integers: the array header followed by each
+    # value, with one buffer reservation instead of a method call per element.
+    # All values are checked (and the exact size computed) before anything is
+    # written, so a bad value leaves the buffer untouched.
+    def encodeUnsignedArray(self, values):
+        size = _header_size(len(values))
+        for value in values:
+            if value < 0:
+                raise Exception("Unsupported negative value {} in encodeUnsignedArray()".format(value))
+            if value > MAX_UINT64:
+                raise Exception("Unsupported byte length of {} for value in encodeUnsignedArray()".format((value.bit_length() + 7) // 8))
+            size += _header_size(value)
+
+        self._reserve(size)
+        buf = self.buf
+        start = self._pos
+        pos = _encode_tv(buf, start, _MAJ_ARR, len(values))
+        for value in values:
+            pos = _encode_tv(buf, pos, _MAJ_UINT, value)
+        self._pos = pos
+        return pos - start
 
     def encodeMapSize(self, value):
-        return self.encodeTagAndValue(Tag.Major.map, value)
+        if value < 24:
+            self._write_byte(_MAJ_MAP | value)
+            return 1
+        return self.encodeTagAndValue(_MAJ_MAP, value)
 
 
 class CBORDecoder:
@@ -181,121 +354,90 @@ class CBORDecoder:
         self.pos = 0
 
     def decodeTagAndAdditional(self, flags=Flag.none):
-        if self.pos == len(self.buf):
+        buf = self.buf
+        pos = self.pos
+        if pos == len(buf):
             raise Exception("Not enough input")
-        octet = self.buf[self.pos]
-        self.pos += 1
-        tag = octet & Tag.Major.mask
-        additional = octet & Tag.Minor.mask
+        octet = buf[pos]
+        self.pos = pos + 1
+        tag = octet & _MAJ_MASK
+        additional = octet & _MIN_MASK
         return (tag, additional, 1)
 
     def decodeTagAndValue(self, flags):
-        end = len(self.buf)
-
-        if self.pos == end:
-            raise Exception("Not enough input")        
-
-        (tag, additional, length) = self.decodeTagAndAdditional(flags)
-        if additional < Tag.Minor.length1:
-            value = additional
-            return (tag, value, length)
-
-        value = 0
-        if additional == Tag.Minor.length8:
-            if end - self.pos < 8:
-                raise Exception("Not enough input")            
-            for shift in [56, 48, 40, 32, 24, 16, 8, 0]:
-                value |= self.buf[self.pos] << shift
-                self.pos += 1
-            if ((flags & Flag.requireMinimalEncoding) and value == 0):
-                raise Exception("Encoding not minimal")
-            return (tag, value, self.pos)
-        elif additional == Tag.Minor.length4:
-            if end - self.pos < 4:
-                raise Exception("Not enough input")            
-            for shift in [24, 16, 8, 0]:
-                value |= self.buf[self.pos] << shift
-                self.pos += 1
-            if ((flags & Flag.requireMinimalEncoding) and value == 0):
-                raise Exception("Encoding not minimal")
-            return (tag, value, self.pos)
-        elif additional == Tag.Minor.length2:
-            if end - self.pos < 2:
-                raise Exception("Not enough input")            
-            for shift in [8, 0]:
-                value |= self.buf[self.pos] << shift
-                self.pos += 1
-            if ((flags & Flag.requireMinimalEncoding) and value == 0):
-                raise Exception("Encoding not minimal")
-            return (tag, value, self.pos)
-        elif additional == Tag.Minor.length1:
-            if end - self.pos < 1:
-                raise Exception("Not enough input")            
-            value |= self.buf[self.pos]
-            self.pos += 1
-            if ((flags & Flag.requireMinimalEncoding) and value == 0):
-                raise Exception("Encoding not minimal")
-            return (tag, value, self.pos)
-
-        raise Exception("Bad additional value")
+        start = self.pos
+        (tag, value, pos) = _decode_tv(self.buf, start, flags)
+        self.pos = pos
+        return (tag, value, pos - start)
 
     def decodeUnsigned(self, flags=Flag.none):
         (tag, value, length) = self.decodeTagAndValue(flags)
-        if tag != Tag.Major.unsignedInteger:
-            raise Exception("Expected Tag.Major.unsignedInteger ({}), but found {}".format(Tag.Major.unsignedInteger, tag))
+        if tag != _MAJ_UINT:
+            raise Exception("Expected Tag.Major.unsignedInteger ({}), but found {}".format(_MAJ_UINT, tag))
         return (value, length)
 
     def decodeNegative(self, flags=Flag.none):
         (tag, value, length) = self.decodeTagAndValue(flags)
-        if tag != Tag.Major.negativeInteger:
+        if tag != _MAJ_NEG:
             raise Exception("Expected Tag.Major.negativeInteger, but found {}".format(tag))
         return (value, length)
 
     def decodeInteger(self, flags=Flag.none):
         (tag, value, length) = self.decodeTagAndValue(flags)
-        if tag == Tag.Major.unsignedInteger:
+        if tag == _MAJ_UINT:
             return (value, length)
-        elif tag == Tag.Major.negativeInteger:
-            return (-1 - value, length)  # TODO: Check that this is the right way -- do we need to use struct.unpack()?
+        elif tag == _MAJ_NEG:
+            return (-1 - value, length)
+        raise Exception("Expected Tag.Major.unsignedInteger or Tag.Major.negativeInteger, but found {}".format(tag))
 
     def decodeBool(self, flags=Flag.none):
         (tag, value, length) = self.decodeTagAndValue(flags)
-        if tag == Tag.Major.simple:
-            if value == Tag.Minor.true:
+        if tag == _MAJ_SIMP:
+            if value == _MIN_TRUE:
                 return (True, length)
-            elif value == Tag.Minor.false:
+            elif value == _MIN_FALSE:
                 return (False, length)
             raise Exception("Not a Boolean")
         raise Exception("Not Simple/Boolean")
 
     def decodeBytes(self, flags=Flag.none):
+        # Copy straight out of a view of the input so the payload is copied once
+        (value, length) = self.decodeBytesView(flags)
+        return (bytes(value), length)
+
+    # Like decodeBytes(), but returns a memoryview into the input buffer
+    # instead of a copy. The view aliases the buffer passed to the decoder, so
+    # it only stays valid while that buffer is left unchanged.
+    def decodeBytesView(self, flags=Flag.none):
         # First value is the length of the bytes that follow
         (tag, byte_length, size_length) = self.decodeTagAndValue(flags)
-        if tag != Tag.Major.byteString:
+        if tag != _MAJ_BSTR:
             raise Exception("Not a byteString")
 
-        end = len(self.buf)
-        if end - self.pos < byte_length:
+        buf = self.buf
+        pos = self.pos
+        end = pos + byte_length
+        if end > len(buf):
             raise Exception("Not enough input")
 
-        value = bytes(self.buf[self.pos : self.pos + byte_length])
-        self.pos += byte_length
+        value = memoryview(buf)[pos : end]
+        self.pos = end
         return (value, size_length + byte_length)
 
     def decodeEncodedBytesPrefix(self, flags=Flag.none):
         (tag, value, length1) = self.decodeTagAndValue(flags)
-        if tag != Tag.Major.semantic or value != Tag.Minor.cborEncodedData:
+        if tag != _MAJ_SEM or value != _MIN_CBOR_DATA:
             raise Exception("Not CBOR Encoded Data")
 
         (tag, value, length2) = self.decodeTagAndValue(flags)
-        if tag != Tag.Major.byteString:
+        if tag != _MAJ_BSTR:
             raise Exception("Not byteString")
 
         return (tag, value, length1 + length2)
 
     def decodeEncodedBytes(self, flags=Flag.none):
         (tag, minor_tag, tag_length) = self.decodeTagAndValue(flags)
-        if tag != Tag.Major.semantic or minor_tag != Tag.Minor.cborEncodedData:
+        if tag != _MAJ_SEM or minor_tag != _MIN_CBOR_DATA:
             raise Exception("Not CBOR Encoded Data")
 
         (value, length) = self.decodeBytes(flags)
@@ -304,26 +446,28 @@ class CBORDecoder:
     def decodeText(self, flags=Flag.none):
         # First value is the length of the bytes that follow
         (tag, byte_length, size_length) = self.decodeTagAndValue(flags)
-        if tag != Tag.Major.textString:
+        if tag != _MAJ_TSTR:
             raise Exception("Not a textString")
 
-        end = len(self.buf)
-        if end - self.pos < byte_length:
+        buf = self.buf
+        pos = self.pos
+        end = pos + byte_length
+        if end > len(buf):
             raise Exception("Not enough input")
 
-        value = bytes(self.buf[self.pos : self.pos + byte_length])
-        self.pos += byte_length
+        value = str(buf[pos : end], 'utf-8')
+        self.pos = end
         return (value, size_length + byte_length)
 
     def decodeArraySize(self, flags=Flag.none):
         (tag, value, length) = self.decodeTagAndValue(flags)
 
-        if tag != Tag.Major.array:
+        if tag != _MAJ_ARR:
             raise Exception("Expected Tag.Major.array, but found {}".format(tag))
         return (value, length)
 
     def decodeMapSize(self, flags=Flag.none):
         (tag, value, length) = self.decodeTagAndValue(flags)
-        if tag != Tag.Major.mask:
+        if tag != _MAJ_MAP:
             raise Exception("Expected Tag.Major.map, but found {}".format(tag))
         return (value, length)
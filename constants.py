@@ -5,5 +5,7 @@
 # Licensed under the "BSD-2-Clause Plus Patent License"
 #
 
+MAX_UINT8 = 0xff
+MAX_UINT16 = 0xffff
 MAX_UINT32 = 0xffffffff
 MAX_UINT64 = 0xffffffffffffffff
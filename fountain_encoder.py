@@ -54,14 +54,14 @@ class Part:
             raise InvalidHeader()
 
     def cbor(self):
-        encoder = CBOREncoder()
-        encoder.encodeArraySize(5)
-        encoder.encodeInteger(self.seq_num)
-        encoder.encodeInteger(self.seq_len)
-        encoder.encodeInteger(self.message_len)
-        encoder.encodeInteger(self.checksum)
-        encoder.encodeBytes(self.data)
-        return encoder.get_bytes()
+        with CBOREncoder() as encoder:
+            encoder.encodeArraySize(5)
+            encoder.encodeInteger(self.seq_num)
+            encoder.encodeInteger(self.seq_len)
+            encoder.encodeInteger(self.message_len)
+            encoder.encodeInteger(self.checksum)
+            encoder.encodeBytes(self.data)
+            return encoder.get_bytes()
 
     def seq_num(self):
         return self.seq_num
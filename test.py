@@ -19,6 +19,7 @@ from fountain_encoder import FountainEncoder, Part
 from fountain_decoder import FountainDecoder
 from ur_encoder import UREncoder
 from ur_decoder import URDecoder
+from cbor_lite import CBOREncoder, CBORDecoder, Tag, _BufPool, get_byte_length
 
 def check_crc32(input, expected_hex):
     checksum = crc32_int(bytes(input, 'utf8'))
@@ -359,6 +360,153 @@ class TestUR(unittest.TestCase):
         cbor2 = part2.cbor()
         assert(cbor == cbor2)
 
+    def test_cbor_unsigned(self):
+        values = [0, 23, 24, 255, 256, 65535, 65536, 0xffffffff, 0x100000000, 0xffffffffffffffff]
+        expected_sizes = [1, 1, 2, 2, 3, 3, 5, 5, 9, 9]
+        encoder = CBOREncoder()
+        for value, expected_size in zip(values, expected_sizes):
+            assert(encoder.encodeUnsigned(value) == expected_size)
+        assert(data_to_hex(encoder.get_bytes()) ==
+            "00" + "17" + "1818" + "18ff" + "190100" + "19ffff" + "1a00010000" + "1affffffff" +
+            "1b0000000100000000" + "1bffffffffffffffff")
+
+        decoder = CBORDecoder(encoder.get_bytes())
+        for value, expected_size in zip(values, expected_sizes):
+            assert(decoder.decodeUnsigned() == (value, expected_size))
+
+        expected_byte_lengths = [0, 0, 1, 1, 2, 2, 3, 4, 5, 8]
+        for value, expected_byte_length in zip(values, expected_byte_lengths):
+            assert(get_byte_length(value) == expected_byte_length)
+        assert(get_byte_length(1 << 64) == 9)
+
+    def test_cbor_integer(self):
+        values = [0, 1, -1, -24, -25, 1000, -1000, -0x10000000000000000]
+        encoder = CBOREncoder()
+        for value in values:
+            encoder.encodeInteger(value)
+        encoder.encodeBool(True)
+        assert(data_to_hex(encoder.get_bytes()) ==
+            "00" + "01" + "20" + "37" + "3818" + "1903e8" + "3903e7" + "3bffffffffffffffff" + "f5")
+
+        decoder = CBORDecoder(encoder.get_bytes())
+        for value in values:
+            assert(decoder.decodeInteger()[0] == value)
+        with self.assertRaises(Exception):
+            decoder.decodeInteger()
+
+    def test_cbor_unsigned_array(self):
+        values = [1, 24, 1000, 0x12345678] * 10
+        encoder = CBOREncoder(8)
+        length = encoder.encodeUnsignedArray(values)
+
+        expected = CBOREncoder()
+        expected_length = expected.encodeArraySize(len(values))
+        for value in values:
+            expected_length += expected.encodeUnsigned(value)
+        assert(length == expected_length)
+        assert(encoder.get_bytes() == expected.get_bytes())
+
+        with self.assertRaises(Exception) as context:
+            encoder.encodeUnsignedArray([1, -1])
+        assert(str(context.exception) == "Unsupported negative value -1 in encodeUnsignedArray()")
+        assert(encoder.get_bytes() == expected.get_bytes())
+        with self.assertRaises(Exception):
+            encoder.encodeUnsignedArray([1, 1 << 64])
+        assert(encoder.get_bytes() == expected.get_bytes())
+
+        encoder = CBOREncoder(8)
+        assert(encoder.encodeUnsignedArray([1] * 100000) == 100005)
+        assert(len(encoder.buf) < 100005 + 256)
+
+    def test_cbor_not_enough_input(self):
+        for truncated in ["", "18", "1901", "1a000100", "1b00000001000000"]:
+            decoder = CBORDecoder(bytes.fromhex(truncated))
+            with self.assertRaises(Exception) as context:
+                decoder.decodeUnsigned()
+            assert(str(context.exception) == "Not enough input")
+
+    def use_empty_buf_pool(self):
+        saved_pool = _BufPool._pool
+        _BufPool._pool = []
+        self.addCleanup(setattr, _BufPool, '_pool', saved_pool)
+
+    def test_cbor_encoder_reuses_buffer(self):
+        self.use_empty_buf_pool()
+        with CBOREncoder() as encoder:
+            encoder.encodeBytes(bytes([1, 5, 3, 3, 5]))
+            buf = encoder.buf
+            first = encoder.get_bytes()
+        assert(encoder.buf is None)
+        assert(buf[:6] == bytes(6))
+
+        with CBOREncoder() as encoder:
+            assert(encoder.buf is buf)
+            encoder.encodeArraySize(5)
+            assert(encoder.get_bytes() == bytes([0x85]))
+        assert(first == bytes([0x45, 1, 5, 3, 3, 5]))
+
+    def test_cbor_encoder_zeroes_buffer_after_failed_encode(self):
+        self.use_empty_buf_pool()
+        with self.assertRaises(Exception):
+            with CBOREncoder() as encoder:
+                encoder.encodeUnsigned(0x1234)
+                encoder.encodeUnsignedArray([0x1234, 0x5678, 0x9abc, -1])
+        buf = _BufPool._pool[0]
+        assert(buf == bytes(len(buf)))
+
+    def test_cbor_text(self):
+        encoder = CBOREncoder()
+        assert(encoder.encodeText("Wolf") == 5)
+        assert(encoder.encodeText("\u00fc") == 3)
+        assert(data_to_hex(encoder.get_bytes()) == "64576f6c6662c3bc")
+
+        decoder = CBORDecoder(encoder.get_bytes())
+        assert(decoder.decodeText() == ("Wolf", 5))
+        assert(decoder.decodeText() == ("\u00fc", 3))
+
+        decoder = CBORDecoder(memoryview(encoder.get_bytes()))
+        assert(decoder.decodeText() == ("Wolf", 5))
+        assert(decoder.decodeText() == ("\u00fc", 3))
+
+    def test_cbor_bytes_view(self):
+        encoder = CBOREncoder()
+        encoder.encodeBytes(bytes([1, 5, 3, 3, 5]))
+        buf = encoder.get_bytes()
+        decoder = CBORDecoder(buf)
+        (view, length) = decoder.decodeBytesView()
+        assert(length == 6)
+        assert(bytes(view) == bytes([1, 5, 3, 3, 5]))
+        buf[1] = 9
+        assert(view[0] == 9)
+
+    def test_cbor_fixed_headers(self):
+        encoder = CBOREncoder()
+        assert(encoder.encodeBool(True) == 1)
+        assert(encoder.encodeBool(False) == 1)
+        assert(encoder.encodeArraySize(23) == 1)
+        assert(encoder.encodeArraySize(24) == 2)
+        assert(encoder.encodeMapSize(0) == 1)
+        assert(encoder.encodeEncodedBytes(bytes([0x85])) == 4)
+        assert(data_to_hex(encoder.get_bytes()) == "f5f4979818a0d8184185")
+
+        decoder = CBORDecoder(encoder.get_bytes())
+        assert(decoder.decodeBool() == (True, 1))
+        assert(decoder.decodeBool() == (False, 1))
+        assert(decoder.decodeArraySize() == (23, 1))
+        assert(decoder.decodeArraySize() == (24, 2))
+        assert(decoder.decodeMapSize() == (0, 1))
+        assert(decoder.decodeEncodedBytes() == (bytes([0x85]), 4))
+
+    def test_cbor_map_and_encoded_bytes(self):
+        encoder = CBOREncoder()
+        assert(encoder.encodeMapSize(2) == 1)
+        assert(encoder.encodeEncodedBytesPrefix(3) == 3)
+        assert(data_to_hex(encoder.get_bytes()) == "a2d81843")
+
+        decoder = CBORDecoder(encoder.get_bytes())
+        assert(decoder.decodeMapSize() == (2, 1))
+        assert(decoder.decodeEncodedBytesPrefix() == (Tag.Major.byteString, 3, 3))
+
     def test_single_part_ur(self):
         ur = make_message_ur(50)
         encoded = UREncoder.encode(ur)